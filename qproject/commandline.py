@@ -1,16 +1,18 @@
 import sys
 import argparse
+import functools
 import logging
-import logging.handlers
 import os
-import shutil
-from . import projects, utils
 
 
 logger = logging.getLogger(__name__)
 
 
 def init_logging(jobid=None, name=None, daemon=True):
+    import atexit
+    import logging.handlers
+    import queue
+
     if daemon:
         handler = logging.handlers.SysLogHandler('/dev/log')
     else:
@@ -30,16 +32,31 @@ def init_logging(jobid=None, name=None, daemon=True):
 
     handler.setFormatter(formatter)
 
-    logger.addHandler(handler)
+    # Hand records to a background thread, so that logging calls do not
+    # block on syslog. Threads do not survive a fork, so the listener is
+    # drained before and restarted after forking the daemon.
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, handler, respect_handler_level=True
+    )
+    listener.start()
+    os.register_at_fork(before=listener.stop,
+                        after_in_parent=listener.start,
+                        after_in_child=listener.start)
+    atexit.register(listener.stop)
+    queue_handler = logging.handlers.QueueHandler(records)
+
+    logger.addHandler(queue_handler)
     logger.setLevel(logging.DEBUG)
 
     for module in ['qproject.utils', 'qproject.projects']:
         module_logger = logging.getLogger(module)
         module_logger.setLevel(logging.DEBUG)
-        module_logger.addHandler(handler)
+        module_logger.addHandler(queue_handler)
 
 
-def parse_args():
+@functools.lru_cache(maxsize=1)
+def _build_parser():
     parser = argparse.ArgumentParser(
         description='Download data from OpenBIS and prepare working directory'
     )
@@ -73,6 +90,10 @@ def parse_args():
     parser.add_argument('--barcode', help='barcode for dropbox')
     parser.add_argument('--daemon', '-d', help="Daemonize qproject",
                         action="store_true", default=False)
+    parser.add_argument('--foreground', help="With --daemon, do not fork "
+                        "but write the pidfile and run in this process, "
+                        "e.g. under a service manager like systemd",
+                        action="store_true", default=False)
     parser.add_argument('--pidfile', help="Path to pidfile")
     parser.add_argument('--umask', help="Umask for files in workdir",
                         default=0o077)
@@ -80,7 +101,11 @@ def parse_args():
                         default=False, action='store_true')
     parser.add_argument('--ref', help='Copy these files to the ref directory',
                         nargs='+', default=[])
-    return parser.parse_args()
+    return parser
+
+
+def parse_args():
+    return _build_parser().parse_args()
 
 
 def validate_args(args):
@@ -89,6 +114,8 @@ def validate_args(args):
             raise ValueError("barcode must be specified if dropbox is")
         if not args.user:
             raise ValueError("specify user to copy back data")
+    if args.foreground and not args.daemon:
+        raise ValueError("foreground can only be specified with daemon")
     if args.daemon and not args.pidfile:
         raise ValueError("pidfile must be specified if daemon is")
     if args.daemon:
@@ -101,27 +128,32 @@ def validate_args(args):
                          args.command)
 
 
-def create_command(args, clone=True, copy_data=True):
-    workflow = projects.Workflow(
-        args.target, remote=args.workflow, commit=args.commit,
-        params=args.params
-    )
-
-    if clone:
-        workflow.create(user=args.user, group=args.group)
-        workflow.clone()
-        workflow.write_config(args.user, args.group)
+def create_command(args, workflow, clone=True, copy_data=True):
+    from concurrent.futures import ThreadPoolExecutor
+    from . import projects
 
     dirs = workflow.dirs
 
-    if args.data and copy_data:
-        projects.copy_data(dirs.data, args.data, args.user, args.group)
-    if args.ref and copy_data:
-        projects.copy_data(dirs.ref, args.ref, args.user, args.group)
+    # Cloning is bound by the network, so stage the input data meanwhile.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        if clone:
+            workflow.create(user=args.user, group=args.group)
+            cloned = executor.submit(workflow.clone)
+
+        if args.data and copy_data:
+            projects.copy_data(dirs.data, args.data, args.user, args.group)
+        if args.ref and copy_data:
+            projects.copy_data(dirs.ref, args.ref, args.user, args.group)
+
+        if clone:
+            cloned.result()
+            workflow.write_config(args.user, args.group)
     return workflow
 
 
 def _run(workflow, args):
+    from . import utils
+
     dirs = workflow.dirs
     if not os.path.exists(dirs.src):
         raise ValueError(
@@ -130,8 +162,7 @@ def _run(workflow, args):
     if workflow.params is not None:
         workflow.write_config(args.user, args.group)
     popen = workflow.run(user=args.user)
-    popen.wait()
-    if popen.returncode:
+    if utils.log_output(popen):
         raise RuntimeError(
             "Workflow return non-zero returncode. See "
             "workflow log for details"
@@ -140,11 +171,9 @@ def _run(workflow, args):
     workflow.archive_result()
 
 
-def run_command(args):
-    workflow = projects.Workflow(
-        args.target, remote=args.workflow, commit=args.commit,
-        params=args.params
-    )
+def run_command(args, workflow):
+    from . import utils
+
     dirs = workflow.dirs
 
     if args.workflow:
@@ -153,19 +182,22 @@ def run_command(args):
 
     if not os.path.exists(dirs.src):
         raise ValueError("Workflow does not exist: %s" % dirs.src)
-    elif not os.listdir(dirs.src):
+    elif utils.dir_is_empty(dirs.src):
         raise ValueError("Empty workflow dir: %s" % dirs.src)
 
     if args.daemon:
         def run():
             _run(workflow, args)
-        utils.daemonize(run, args.pidfile, args.umask)
+        utils.daemonize(run, args.pidfile, args.umask,
+                        foreground=args.foreground)
     else:
         os.umask(args.umask)
         _run(workflow, args)
 
 
-def commit_command(args):
+def commit_command(args, workflow):
+    import shutil
+
     try:
         logger.info("Write results and logs to dropbox")
 
@@ -181,11 +213,10 @@ def commit_command(args):
                 (dropbox, args.target)
             )
 
-        workflow = projects.Workflow(args.target)
         workflow.commit(dropbox, args.user, umask=0o077)
         if args.cleanup:
             logger.info("Removing workspace")
-            shutil.rmtree(workflow.dirs.root)
+            shutil.rmtree(workflow.dirs.base)
     except:
         logger.critical("Failed to write results to dropbox.")
         raise
@@ -203,12 +234,19 @@ def main():
             "Starting qproject for user %s with command '%s' and target '%s'",
             args.user, args.command, args.target
         )
+
+        from . import projects
+
+        workflow = projects.Workflow(
+            args.target, remote=args.workflow, commit=args.commit,
+            params=args.params
+        )
         if args.command == 'create':
-            create_command(args)
+            create_command(args, workflow)
         elif args.command == 'run':
-            run_command(args)
+            run_command(args, workflow)
         elif args.command == 'commit':
-            commit_command(args)
+            commit_command(args, workflow)
         logger.info('qproject finished succesfully')
         retcode = 0
     except Exception:
@@ -1,18 +1,19 @@
 from __future__ import print_function
 
 import collections
+import concurrent.futures
 import os
 import subprocess
 import re
-import shutil
 import logging
-import pwd
 import json
 import time
 from . import utils
 
 logger = logging.getLogger(__name__)
 
+_WORKFLOW_NAME_RE = re.compile(r"^[_a-zA-Z0-9\-]+$")
+
 Workspace = collections.namedtuple(
     'Workspace',
     ['base', 'data', 'ref', 'src', 'var', 'result', 'run', 'etc',
@@ -68,9 +69,10 @@ class Workflow(object):
             if remote is not None:
                 name = remote.split('/')[-1]
 
-        if name and re.match("^[_a-zA-Z0-9\-]+$", name) is None:
+        if name and _WORKFLOW_NAME_RE.match(name) is None:
             raise ValueError("Invalid workflow name: %s" % name)
 
+        root = os.path.abspath(root)
         dirs = tuple(os.path.join(root, name) for name in Workspace._fields[1:])
         self.dirs = Workspace(*((root, ) + dirs))
         self.name = name
@@ -80,10 +82,16 @@ class Workflow(object):
 
     def create(self, mode=0o777, user=None, group=None):
         """ Create all workflow directories specified in `self.dirs`. """
+        created = []
         for directory in self.dirs:
-            if not os.path.exists(directory):
+            try:
                 os.mkdir(directory, mode)
-                utils.add_acl(directory, 'rwx', user, group)
+            except FileExistsError:
+                if not os.path.isdir(directory):
+                    raise
+            else:
+                created.append(directory)
+        utils.add_acl_many(created, 'rwx', user, group)
 
     def write_config(self, user=None, group=None):
         """ Write a config file to src containing paths and parameters.
@@ -91,20 +99,20 @@ class Workflow(object):
         Do not call this method before `clone`, or git will complain
         about an existing non-empty directory.
         """
+        # All directories are absolute, as the root is made absolute
         config = self.dirs._asdict()
-        for key in config:
-            config[key] = os.path.abspath(config[key])
         if self.params is not None:
-            if self.params is not None:
-                with open(self.params) as params:
-                    config['params'] = json.load(params)
-            else:
-                config['params'] = {}
+            with open(self.params) as params:
+                config['params'] = json.load(params)
 
         path = os.path.join(self.dirs.src, 'config.json')
         logger.debug("Writing config file %s" % path)
-        with open(path, 'w') as f:
-            json.dump(config, f, indent=4)
+        # Replace the config atomically, so that a workflow never reads a
+        # partially written file.
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(config, indent=4))
+        os.replace(tmp_path, path)
         utils.add_acl(path, 'r', user, group)
 
     def clone(self):
@@ -115,15 +123,24 @@ class Workflow(object):
 
     def _check_runnable(self):
         """ Check if all directories and the config file exist. """
-        for directory in self.dirs:
-            if not os.path.isdir(directory):
-                raise ValueError("Could not find directory %s" % directory)
+        if not os.path.isdir(self.dirs.base):
+            raise ValueError("Could not find directory %s" % self.dirs.base)
+        with os.scandir(self.dirs.base) as entries:
+            existing = set(entry.name for entry in entries if entry.is_dir())
+        missing = set(Workspace._fields[1:]) - existing
+        if missing:
+            raise ValueError("Could not find directories %s in %s" %
+                             (", ".join(sorted(missing)), self.dirs.base))
         config = os.path.join(self.dirs.src, 'config.json')
         if not os.path.exists(config):
             logger.warn("Config file is missing: %s" % config)
 
     def run(self, user=None):
-        """ Execute the workflow as `user` and return a Popen. """
+        """ Execute the workflow as `user` and return a Popen.
+
+        The output of the workflow can be read from the `stdout` pipe of
+        the Popen, see `utils.log_output`.
+        """
 
         logger.info("Executing workflow.")
         self._check_runnable()
@@ -137,7 +154,10 @@ class Workflow(object):
         if user:
             args.append(user)
 
-        process = subprocess.Popen(args, cwd=self.dirs.src)
+        process = subprocess.Popen(
+            args, cwd=self.dirs.src, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, bufsize=0
+        )
 
         return process
 
@@ -146,7 +166,7 @@ class Workflow(object):
 
         If `user` is specified, copy only files that are owned by `user`.
         """
-        userid = pwd.getpwnam(user).pw_uid if user else None
+        userid = utils.user_id(user) if user else None
         if umask:
             old_umask = os.umask(umask)
         try:
@@ -169,43 +189,71 @@ class Workflow(object):
         # TODO
         return {}
 
-    def archive_result(self):
+    def archive_result(self, compress_level=1,
+                       store_suffixes=utils.COMPRESSED_SUFFIXES):
         """ Write a zip file to archive that contains src, log and etc.
 
         It also contains a file `meta.json` with some information like
         origin of github repository and checksums of input and output files.
+        Files are deflated with `compress_level`, except for files ending
+        in one of `store_suffixes`, which are already compressed.
         """
+        meta = self.describe_state()
+        meta_file = os.path.join(self.dirs.base, 'meta.json')
+        with open(meta_file, 'w') as f:
+            f.write(json.dumps(meta))
+        data = [self.dirs.src, self.dirs.etc, self.dirs.logs, meta_file]
+
+        # Creating the file exclusively reserves its name, so concurrent
+        # archives in the same second get a numbered suffix.
         time_str = time.strftime("%Y-%m-%dT%H%M%S-%Z")
-        dest = os.path.join(self.dirs.archive, time_str) + ".zip"
-        for _ in range(10):
-            if not os.path.exists(dest):
-                break
-            else:
-                time.sleep(.5)
-                time_str = time.strftime("%Y-%m-%dT%H%M%S-%Z")
-                dest = os.path.join(self.dirs.archive, time_str) + ".zip"
+        base = os.path.join(self.dirs.archive, time_str)
+        for i in range(1000):
+            dest = base + ('-%s' % i if i else '') + ".zip"
+            try:
+                fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                             0o666)
+            except FileExistsError:
+                continue
+            break
         else:
             raise ValueError("Could not write archive.")
 
         logger.info("Writing archive to %s" % dest)
-        meta = self.describe_state()
-        meta_file = os.path.join(self.dirs.base, 'meta.json')
-        with open(meta_file, 'w') as f:
-            json.dump(meta, f)
-        data = [self.dirs.src, self.dirs.etc, self.dirs.logs, meta_file]
-        utils.write_zip(data, dest)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                utils.write_zip(data, f, compress_level, store_suffixes)
+        except Exception:
+            os.remove(dest)
+            raise
         return dest
 
 
-def copy_data(target, data, user=None, group=None, permissions='r'):
+def _copy_file(path, dest):
+    logger.debug("Copying %s to %s", path, dest)
+    utils.copyfile(path, dest)
+
+
+def copy_data(target, data, user=None, group=None, permissions='r',
+              max_workers=8):
     """ Copy a list of data files to `workspace.data`.
 
-    If `user` or `group` is specified set an acl for this group or user.
+    Up to `max_workers` files are copied concurrently. If `user` or `group`
+    is specified set an acl for this group or user on all copied files.
     """
     logger.info("Copying data files to %s" % target)
-    for path in data:
-        base, name = os.path.split(path)
-        dest = os.path.join(target, name)
-        logger.debug("Copying %s to %s", path, dest)
-        shutil.copyfile(path, dest)
-        utils.add_acl(dest, permissions, user, group)
+    if not data:
+        return
+    target_dir = os.path.join(target, '')
+    dests = [target_dir + os.path.basename(path) for path in data]
+    # Files with the same name would be written concurrently to one file
+    if len(set(dests)) != len(dests):
+        raise ValueError("Data files must have distinct names: %s" %
+                         ", ".join(data))
+    workers = min(max_workers, len(data))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = [executor.submit(_copy_file, path, dest)
+                   for path, dest in zip(data, dests)]
+        for future in futures:
+            future.result()
+    utils.add_acl_many(dests, permissions, user, group)
@@ -1,139 +1,598 @@
 import atexit
+import concurrent.futures
+import errno
+import fcntl
+import functools
+import grp
 import logging
 import os
+import pwd
 import re
+import selectors
+import stat
 import subprocess
 import sys
-import shutil
+import zipfile
+try:
+    import posix1e
+except ImportError:
+    posix1e = None
 
 logger = logging.getLogger(__name__)
 
-USER_REGEX = "^[a-zA-Z0-9]*$"
+USER_REGEX = re.compile(r"^[a-zA-Z0-9]+$")
+PERMISSIONS_REGEX = re.compile(r"^[-rwx]+$")
+REF_REGEX = re.compile(r"^[a-zA-Z0-9_./\-]+$")
+SHA_REGEX = re.compile(r"^[0-9a-fA-F]{7,40}$")
+
+# ioctl to share the data blocks of one file with another (linux/fs.h)
+FICLONE = 0x40049409
+
+# Errors that mean a copy strategy is not supported for a pair of files
+_COPY_FALLBACK_ERRNOS = (
+    errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS, errno.ENOTTY
+)
+_KERNEL_COPY_SIZE = 1 << 30
+# Errors if the kernel or filesystem does not support O_TMPFILE
+_TMPFILE_FALLBACK_ERRNOS = (errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL)
+# Bytes of file names passed to one setfacl call, well below ARG_MAX
+SETFACL_ARGS_SIZE = 128 * 1024
+# Buffer size if data has to be copied through userspace
+COPY_BUFSIZE = 1024 * 1024
+
+# Files that are compressed already and are not worth deflating again
+COMPRESSED_SUFFIXES = ('.gz', '.bam', '.zip', '.bz2', '.xz', '.zst')
+
+
+@functools.lru_cache(maxsize=32)
+def user_id(user):
+    """ Return the uid of `user`, caching the lookup in the user database. """
+    return pwd.getpwnam(user).pw_uid
+
+
+@functools.lru_cache(maxsize=32)
+def group_id(group):
+    """ Return the gid of `group`, caching the lookup in the group database.
+    """
+    return grp.getgrnam(group).gr_gid
+
+
+def _modify_acl(file, entries, permissions):
+    """ Set acl entries of `file` in-process, like `setfacl -m` would. """
+    perms = {
+        'r': posix1e.ACL_READ,
+        'w': posix1e.ACL_WRITE,
+        'x': posix1e.ACL_EXECUTE,
+    }
+    acl = posix1e.ACL(file=file)
+    for tag, qualifier in entries:
+        for entry in acl:
+            if entry.tag_type == tag and entry.qualifier == qualifier:
+                break
+        else:
+            entry = acl.append()
+            entry.tag_type = tag
+            entry.qualifier = qualifier
+        entry.permset.clear()
+        for char in permissions:
+            if char != '-':
+                entry.permset.add(perms[char])
+    acl.calc_mask()
+    acl.applyto(file)
 
 
 def add_acl(file, permissions, user=None, group=None):
+    add_acl_many([file], permissions, user, group)
+
+
+def add_acl_many(files, permissions, user=None, group=None):
+    """ Set the same acl on all `files`.
+
+    Use pylibacl if it is installed, so that no process has to be started.
+    Otherwise set the user and group entries with a single setfacl call.
+    """
+    files = list(files)
+    if not files:
+        return
     if user:
-        logger.debug("Add acl %s for %s to file %s", permissions, user, file)
+        logger.debug("Add acl %s for %s to files %s", permissions, user,
+                     ", ".join(files))
     if group:
-        logger.debug("Add acl %s for %s to file %s", permissions, group, file)
-    if user and re.match(USER_REGEX, user) is None:
+        logger.debug("Add acl %s for %s to files %s", permissions, group,
+                     ", ".join(files))
+    if user and USER_REGEX.match(user) is None:
         logger.critical("Tried to set acl for invalid user name %s." % user)
-        raise ValueError("Invalid user name: %s", user)
-    if group and re.match(USER_REGEX, group) is None:
-        logger.critical("Tried to set acl for invalid group name %s." % user)
-        raise ValueError("Invalid group name: %s", user)
-    if re.match("[rwx]*", permissions) is None:
+        raise ValueError("Invalid user name: %s" % user)
+    if group and USER_REGEX.match(group) is None:
+        logger.critical("Tried to set acl for invalid group name %s." % group)
+        raise ValueError("Invalid group name: %s" % group)
+    if PERMISSIONS_REGEX.match(permissions) is None:
         raise ValueError("Invalid acl permissions %s" % permissions)
-    try:
-        if user:
-            arg = 'u:%s:%s' % (user, permissions)
-            subprocess.check_call(['setfacl', '-m', arg, file])
-        if group:
-            arg = 'g:%s:%s' % (group, permissions)
-            subprocess.check_call(['setfacl', '-m', arg, file])
-    except subprocess.CalledProcessError:
-        logger.exception("Could not set acl for directory %s. This will "
-                         "probably lead to failures later" % file)
-
-
-def clone(remote, target, commit=None):
+    if not (user or group):
+        return
+    if posix1e is not None:
+        try:
+            entries = []
+            if user:
+                entries.append((posix1e.ACL_USER, user_id(user)))
+            if group:
+                entries.append((posix1e.ACL_GROUP, group_id(group)))
+            for file in files:
+                _modify_acl(file, entries, permissions)
+        except (KeyError, OSError):
+            logger.exception("Could not set acl for %s. This will probably "
+                             "lead to failures later" % ", ".join(files))
+        return
+    entries = []
+    if user:
+        entries.append('u:%s:%s' % (user, permissions))
+    if group:
+        entries.append('g:%s:%s' % (group, permissions))
+    for chunk in _split_args(files, SETFACL_ARGS_SIZE):
+        try:
+            subprocess.check_call(['setfacl', '-m', ','.join(entries)] +
+                                  chunk)
+        except (OSError, subprocess.CalledProcessError):
+            logger.exception("Could not set acl for %s. This will probably "
+                             "lead to failures later" % ", ".join(chunk))
+
+
+def _split_args(args, size):
+    """ Split `args` into lists whose arguments take at most `size` bytes.
+    """
+    chunk = []
+    chunk_size = 0
+    for arg in args:
+        arg_size = len(os.fsencode(arg)) + 1
+        if chunk and chunk_size + arg_size > size:
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(arg)
+        chunk_size += arg_size
+    if chunk:
+        yield chunk
+
+
+def dir_is_empty(path):
+    """ Check if the directory `path` has no entries, reading at most one. """
+    with os.scandir(path) as entries:
+        return next(entries, None) is None
+
+
+def _is_ref(commit):
+    """ Check if `commit` looks like a branch or tag rather than a commit. """
+    return (commit != 'HEAD' and REF_REGEX.match(commit) is not None and
+            SHA_REGEX.match(commit) is None)
+
+
+def _git(args):
+    # The umask is only changed for git, as other threads may be creating
+    # files while it is running.
+    subprocess.run(['git'] + args, check=True, stdout=subprocess.DEVNULL,
+                   umask=0)
+
+
+def clone(remote, target, commit=None, jobs=8):
+    """ Clone `remote` with its submodules to `target`.
+
+    Only the history needed to check out `commit` is fetched, and up to
+    `jobs` submodules are fetched in parallel.
+    """
     if remote.startswith('github:'):
         remote = 'https://github.com/%s' % remote[len('github:'):]
-    old_mask = os.umask(0)
+    # Creating the target is the check: git accepts an existing empty
+    # directory, so only an existing one needs to be listed.
     try:
-        if os.path.exists(target) and os.listdir(target):
+        os.makedirs(target)
+    except FileExistsError:
+        if not dir_is_empty(target):
             raise ValueError("Target repository exists: %s" % target)
-        logger.info("Cloning %s to %s", remote, target)
-        subprocess.check_call(['git', 'clone', remote, target])
-        if commit is not None:
-            print(target)
-            subprocess.check_call(
-                [
-                    'git',
-                    '--work-tree', target,
-                    '--git-dir', os.path.join(target, '.git'),
-                    'checkout',
-                    commit
-                ]
-            )
+    submodules = ['--recurse-submodules', '--shallow-submodules',
+                  '--jobs=%s' % jobs]
+    logger.info("Cloning %s to %s", remote, target)
+    if commit is None:
+        _git(['clone', '--depth=1'] + submodules + [remote, target])
+        return
+    if _is_ref(commit):
+        # A branch or tag can be cloned on its own, without any history.
+        try:
+            _git(['clone', '--depth=1', '--branch', commit,
+                  '--single-branch'] + submodules + [remote, target])
+            return
+        except subprocess.CalledProcessError:
+            # git only cleans up if the clone itself failed. If e.g. a
+            # submodule failed, the ref existed and the error is real.
+            if not dir_is_empty(target):
+                raise
+            logger.info("%s is not a branch or tag, checking it out as a "
+                        "commit", commit)
+    # Only download the file contents of the commit we check out.
+    _git(['clone', '--filter=blob:none', '--no-checkout', remote, target])
+    _git(['-C', target, 'checkout', commit])
+    if os.path.exists(os.path.join(target, '.gitmodules')):
+        _git(['-C', target, 'submodule', 'update', '--init',
+              '--recursive', '--depth=1', '--jobs=%s' % jobs])
+
+
+def _log_lines(data):
+    """ Log the complete lines in `data` and return the rest. """
+    *lines, rest = data.split(b'\n')
+    for line in lines:
+        logger.info("workflow: %s", line.decode(errors='replace'))
+    return rest
+
+
+def log_output(process, bufsize=64 * 1024, interval=0.1):
+    """ Log the output of `process` line by line until it exits.
+
+    `process` must have been started with `stdout=subprocess.PIPE`.
+    Return its returncode.
+
+    Background processes of the workflow may keep the pipe open after it
+    exited, so the pipe is only drained once the process is gone. The
+    exit is checked every `interval` seconds.
+    """
+    fd = process.stdout.fileno()
+    pending = b''
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_READ)
+        while process.poll() is None:
+            if not selector.select(timeout=interval):
+                continue
+            chunk = os.read(fd, bufsize)
+            if not chunk:
+                break
+            pending = _log_lines(pending + chunk)
+
+    os.set_blocking(fd, False)
+    while True:
+        try:
+            chunk = os.read(fd, bufsize)
+        except BlockingIOError:
+            break
+        if not chunk:
+            break
+        pending = _log_lines(pending + chunk)
+    if pending:
+        logger.info("workflow: %s", pending.decode(errors='replace'))
+    process.stdout.close()
+    return process.wait()
+
+
+def write_zip(paths, dest, level=6, store_suffixes=COMPRESSED_SUFFIXES):
+    """ Zip the files and directories in `paths` into the binary file `dest`.
+
+    Files ending in one of `store_suffixes` are stored as they are, all
+    other files are deflated with compression `level` (0-9). Like `zip -r`,
+    absolute paths are stored without the leading slash, symlinks to
+    regular files are stored as the file they point to, and dangling
+    symlinks and special files like FIFOs are skipped.
+    """
+    store_suffixes = tuple(store_suffixes)
+    compression = zipfile.ZIP_DEFLATED if level else zipfile.ZIP_STORED
+    with zipfile.ZipFile(dest, 'w', compression, allowZip64=True,
+                         compresslevel=level, strict_timestamps=False) as zf:
+        def add(path):
+            try:
+                mode = os.stat(path).st_mode
+            except FileNotFoundError:
+                logger.warning("Not archiving dangling symlink %s", path)
+                return
+            if not stat.S_ISREG(mode):
+                logger.warning("Not archiving special file %s", path)
+                return
+            if path.endswith(store_suffixes):
+                zf.write(path, compress_type=zipfile.ZIP_STORED)
+            else:
+                zf.write(path)
+
+        for path in paths:
+            if not os.path.isdir(path):
+                add(path)
+                continue
+            for root, dirs, files in os.walk(path):
+                zf.write(root)
+                for name in files:
+                    add(os.path.join(root, name))
+
+
+def copy_fd(src_fd, dst_fd):
+    """ Copy the contents of file `src_fd` to the empty file `dst_fd`.
+
+    Try to reflink the file first, then let the kernel copy the data with
+    `copy_file_range`, `sendfile` or `splice`. If none of them works for
+    this pair of files, fall back to copying through a userspace buffer.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return
+    except OSError as e:
+        if e.errno not in _COPY_FALLBACK_ERRNOS:
+            raise
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while os.copy_file_range(src_fd, dst_fd, _KERNEL_COPY_SIZE):
+                pass
+            return
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    try:
+        while os.sendfile(dst_fd, src_fd, None, _KERNEL_COPY_SIZE):
+            pass
+        return
+    except OSError as e:
+        if e.errno not in _COPY_FALLBACK_ERRNOS:
+            raise
+
+    if hasattr(os, 'splice'):
+        try:
+            _splice_copy(src_fd, dst_fd)
+            return
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    buf = bytearray(COPY_BUFSIZE)
+    view = memoryview(buf)
+    while True:
+        size = os.readv(src_fd, [buf])
+        if not size:
+            break
+        written = 0
+        while written < size:
+            written += os.write(dst_fd, view[written:size])
+
+
+def _splice_copy(src_fd, dst_fd):
+    """ Move the data through a pipe, which keeps it in kernel buffers. """
+    pipe_r, pipe_w = os.pipe()
+    try:
+        while True:
+            size = os.splice(src_fd, pipe_w, _KERNEL_COPY_SIZE)
+            if not size:
+                break
+            while size:
+                size -= os.splice(pipe_r, dst_fd, size)
     finally:
-        os.umask(old_mask)
+        os.close(pipe_r)
+        os.close(pipe_w)
+
 
+def copyfile(src, dest):
+    """ Copy the file `src` to `dest` without a userspace buffer if possible.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            copy_fd(src_fd, dst_fd)
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
 
-def write_zip(dirs, dest):
-    """ Zip the dirs and write them to a zip archive `dest`. """
-    subprocess.check_output(
-        ['zip', '-r', dest] + dirs
-    )
 
+def _copy_to_dir(src_fd, dest_fd, name):
+    """ Copy `src_fd` to the new file `name` in the directory `dest_fd`.
 
-def copytree_owner(src, dest, userid):
+    If possible, the data is written to an unnamed O_TMPFILE and linked into
+    the directory when it is complete, so a partial file is never visible.
     """
-    Copy the contents of a directory but ignore files not owned by `userid`.
+    tmp_fd = -1
+    if hasattr(os, 'O_TMPFILE'):
+        try:
+            tmp_fd = os.open('.', os.O_WRONLY | os.O_TMPFILE, 0o666,
+                             dir_fd=dest_fd)
+        except OSError as e:
+            if e.errno not in _TMPFILE_FALLBACK_ERRNOS:
+                raise
+    if tmp_fd >= 0:
+        try:
+            copy_fd(src_fd, tmp_fd)
+            tmp_path = '/proc/self/fd/%d' % tmp_fd
+            try:
+                os.link(tmp_path, name, dst_dir_fd=dest_fd)
+            except FileExistsError:
+                os.unlink(name, dir_fd=dest_fd)
+                os.link(tmp_path, name, dst_dir_fd=dest_fd)
+            return
+        except FileNotFoundError:
+            # /proc is not mounted, copy the file again under its name
+            os.lseek(src_fd, 0, os.SEEK_SET)
+        finally:
+            os.close(tmp_fd)
+
+    dst_fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                     os.O_NOFOLLOW, 0o666, dir_fd=dest_fd)
+    try:
+        copy_fd(src_fd, dst_fd)
+    finally:
+        os.close(dst_fd)
+
+
+def _copy_owned_file(dir_fd, name, src_dir, dest_fd, userid):
+    # The paths are only needed for log messages, so they are joined lazily
+    try:
+        src_fd = os.open(name, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK,
+                         dir_fd=dir_fd)
+    except OSError as e:
+        if e.errno != errno.ELOOP:
+            raise
+        logger.critical("Found symlink %s. Can not write to dropbox",
+                        os.path.join(src_dir, name))
+        return
+    try:
+        st = os.fstat(src_fd)
+        if userid is not None and st.st_uid != userid:
+            logger.critical("Found file with invalid owner. %s should "
+                            "be owned by %s but is owned by %s. Can "
+                            "not write to dropbox",
+                            os.path.join(src_dir, name), userid, st.st_uid)
+            return
+        if not stat.S_ISREG(st.st_mode):
+            logger.critical("Found special file %s. Can not write to "
+                            "dropbox", os.path.join(src_dir, name))
+            return
+        _copy_to_dir(src_fd, dest_fd, name)
+    finally:
+        os.close(src_fd)
+
+
+def _open_owned_dir(dir_fd, name, path, userid):
+    """ Open the subdirectory `name` if it is owned by `userid`. """
+    try:
+        fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                     dir_fd=dir_fd)
+    except OSError as e:
+        if e.errno not in (errno.ELOOP, errno.ENOTDIR):
+            raise
+        logger.critical("Directory %s was replaced. Can not write to "
+                        "dropbox", path)
+        return None
+    owner = os.fstat(fd).st_uid
+    if userid is not None and owner != userid:
+        logger.critical("Found dir with invalid owner. %s should be "
+                        "owned by %s but is owned by %s. Can not "
+                        "write to dropbox", path, userid, owner)
+        os.close(fd)
+        return None
+    return fd
+
+
+def _copytree_owner(dir_fd, path, dest_fd, userid, executor):
+    with os.scandir(dir_fd) as it:
+        entries = list(it)
+
+    # The type of an entry comes from the directory listing, so this does
+    # not cost a stat per entry. Files are still opened without following
+    # symlinks and checked on the descriptor, as they may have been
+    # replaced since the listing.
+    futures = []
+    try:
+        dirs = []
+        for entry in entries:
+            if entry.is_symlink():
+                logger.critical("Found symlink %s. Can not write to dropbox",
+                                os.path.join(path, entry.name))
+            elif entry.is_dir(follow_symlinks=False):
+                dirs.append(entry)
+            else:
+                futures.append(executor.submit(
+                    _copy_owned_file, dir_fd, entry.name, path, dest_fd,
+                    userid
+                ))
+
+        for entry in dirs:
+            sub_path = os.path.join(path, entry.name)
+            sub_fd = _open_owned_dir(dir_fd, entry.name, sub_path, userid)
+            if sub_fd is None:
+                continue
+            try:
+                os.mkdir(entry.name, 0o700, dir_fd=dest_fd)
+                sub_dest_fd = os.open(
+                    entry.name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW,
+                    dir_fd=dest_fd
+                )
+                try:
+                    _copytree_owner(sub_fd, sub_path, sub_dest_fd, userid,
+                                    executor)
+                finally:
+                    os.close(sub_dest_fd)
+            finally:
+                os.close(sub_fd)
+    finally:
+        # The directories must stay open until all their files are copied,
+        # even if copying some other file or directory failed.
+        concurrent.futures.wait(futures)
+    for future in futures:
+        future.result()
+
+
+def copytree_owner(src, dest, userid, max_workers=4):
     """
-    src = os.path.abspath(src)
-    dest = os.path.abspath(dest)
-
-    for root, dirs, files, rootfd in os.fwalk(src):
-        assert root.startswith(src)
-        local_dest = root[len(src) + 1:]
-        local_dest = os.path.join(dest, local_dest)
-
-        root_owner = os.fstat(rootfd).st_uid
-        if root != src and root_owner != userid:
-            logger.critical("Found dir with invalid owner. %s should be "
-                            "owned by %s but is owned by %s. Can not write "
-                            "to dropbox", root, userid, root_owner)
-            continue
+    Copy the contents of a directory but ignore files not owned by `userid`.
 
-        for file in files:
-            def opener(f, flags):
-                return os.open(f, flags, dir_fd=rootfd)
-            with open(file, 'rb', opener=opener) as fsrc:
-                owner = os.fstat(fsrc.fileno()).st_uid
-                if userid is not None and owner != userid:
-                    logger.critical("Found file with invalid owner. %s should "
-                                    "be owned by %s but is owned by %s. Can "
-                                    "not write to dropbox",
-                                    os.path.join(root, file), userid, owner)
-                    continue
-                with open(os.path.join(local_dest, file), 'wb') as fdst:
-                    shutil.copyfileobj(fsrc, fdst)
-
-        for dir in dirs:
-            os.mkdir(os.path.join(local_dest, dir), 0o700)
-
-
-def daemonize(func, pidfile, umask, *args, **kwargs):
-    """ Run ``func`` in new process independent from this one.
+    The owner is checked on the opened file descriptor, so a file can not
+    be swapped for a symlink or hardlink between the check and the copy.
+    This is why the tree is not copied by an external tool like tar.
+    Symlinks and special files are never copied.
 
-    Write the pid of the new daemon to pidfile.
+    Both trees are walked relative to directory file descriptors, and up to
+    `max_workers` files are copied concurrently. Copied files only appear
+    in `dest` once they are complete.
     """
-    logger.info("Starting new daemon")
+    src_fd = os.open(src, os.O_RDONLY | os.O_DIRECTORY)
     try:
-        pid = os.fork()
-    except OSError:
-        logger.critical("Fork failed.")
-        sys.exit(1)
-    if pid:
-        os._exit(0)
+        dest_fd = os.open(dest, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+                _copytree_owner(src_fd, os.path.abspath(src), dest_fd,
+                                userid, pool)
+        finally:
+            os.close(dest_fd)
+    finally:
+        os.close(src_fd)
 
-    # new process group
-    os.setsid()
 
+def _has_controlling_tty():
     try:
-        pid = os.fork()
+        fd = os.open('/dev/tty', os.O_RDWR | os.O_NOCTTY)
     except OSError:
-        logger.error("Fork failed.")
-        sys.exit(1)
+        return False
+    os.close(fd)
+    return True
 
-    if pid:
-        os._exit(0)
 
-    logger.info("PID of new daemon: %s", os.getpid())
+def daemonize(func, pidfile, umask, *args, foreground=False, **kwargs):
+    """ Run ``func`` in new process independent from this one.
+
+    Write the pid of the new daemon to pidfile. With ``foreground``,
+    e.g. when a service manager supervises this process, ``func`` runs
+    in this process instead and its exceptions are raised.
+    """
+    if foreground:
+        logger.info("Running in the foreground, not forking")
+    else:
+        logger.info("Starting new daemon")
+        try:
+            pid = os.fork()
+        except OSError:
+            logger.critical("Fork failed.")
+            sys.exit(1)
+        if pid:
+            os._exit(0)
+
+        # The second fork makes sure the daemon can never acquire a
+        # controlling terminal again. It is only needed if we came from
+        # a terminal, as the daemon itself never opens one.
+        second_fork = _has_controlling_tty()
+
+        # new process group
+        os.setsid()
+
+        if second_fork:
+            try:
+                pid = os.fork()
+            except OSError:
+                logger.error("Fork failed.")
+                sys.exit(1)
+
+            if pid:
+                os._exit(0)
+
+        logger.info("PID of new daemon: %s", os.getpid())
 
     os.umask(umask)
     write_pidfile(pidfile)
+    if foreground:
+        # Errors reach the caller, so the exit code reports them to the
+        # service manager.
+        func(*args, **kwargs)
+        return
     close_open_fds()
     try:
         func(*args, **kwargs)
@@ -144,8 +603,12 @@ def daemonize(func, pidfile, umask, *args, **kwargs):
 
 def write_pidfile(pidfile):
     try:
-        with open(pidfile, 'xt') as f:
-            f.write(str(os.getpid()) + '\n')
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC
+        fd = os.open(pidfile, flags, 0o644)
+        try:
+            os.write(fd, b'%d\n' % os.getpid())
+        finally:
+            os.close(fd)
 
         def remove_pid():
             try:
@@ -164,3 +627,32 @@ def close_open_fds():
     devnull = os.open('/dev/null', os.O_RDWR)
     for i in range(3):
         os.dup2(devnull, i)
+    if devnull > 2:
+        os.close(devnull)
+
+    # Close descriptors inherited from the process that started us. Python
+    # opens its own descriptors non-inheritable (PEP 446), so this leaves
+    # e.g. the socket of the syslog handler alone. That is also why a blind
+    # os.closerange or close_range(2) can not be used here.
+    for fd in _open_fds():
+        if fd < 3:
+            continue
+        try:
+            inheritable = os.get_inheritable(fd)
+        except OSError:
+            continue
+        if inheritable:
+            os.close(fd)
+
+
+def _open_fds():
+    """ Return the open file descriptors of this process.
+
+    The list is read from /proc, which is much faster than probing every
+    possible descriptor up to the limit on open files.
+    """
+    try:
+        # The descriptor of the listing itself is closed again
+        return [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return range(os.sysconf('SC_OPEN_MAX'))
@@ -1,5 +1,5 @@
 import tempfile
-from qproject import projects
+from qproject import commandline, projects, utils
 try:
     from unittest import mock
 except ImportError:
@@ -8,6 +8,7 @@ import os
 import pwd
 import pytest
 import shutil
+import subprocess
 
 
 def touch(file):
@@ -15,8 +16,8 @@ def touch(file):
         pass
 
 
-@mock.patch('subprocess.check_call')
-def test_clone_workflows(check_call):
+@mock.patch('subprocess.run')
+def test_clone_workflows(run):
     tmp = tempfile.mkdtemp()
     try:
         name = 'QTEST'
@@ -24,23 +25,74 @@ def test_clone_workflows(check_call):
         remote = 'github:qbicsoftware/qcprot'
         workflow = projects.Workflow(target, remote=remote, commit='HEAD')
         workflow.clone()
-        check_call.assert_any_call(
-            ['git', 'clone', 'https://github.com/qbicsoftware/qcprot',
-             workflow.dirs.src]
+        run.assert_any_call(
+            ['git', 'clone', '--filter=blob:none', '--no-checkout',
+             'https://github.com/qbicsoftware/qcprot', workflow.dirs.src],
+            check=True, stdout=subprocess.DEVNULL, umask=0
+        )
+        run.assert_any_call(
+            ['git', '-C', workflow.dirs.src, 'checkout', 'HEAD'],
+            check=True, stdout=subprocess.DEVNULL, umask=0
+        )
+    finally:
+        shutil.rmtree(tmp)
+
+
+@mock.patch('subprocess.run')
+def test_clone_tag(run):
+    tmp = tempfile.mkdtemp()
+    try:
+        target = os.path.join(tmp, 'QTEST')
+        remote = 'github:qbicsoftware/qcprot'
+        workflow = projects.Workflow(target, remote=remote, commit='v1.0')
+        workflow.clone()
+        run.assert_called_once_with(
+            ['git', 'clone', '--depth=1', '--branch', 'v1.0',
+             '--single-branch', '--recurse-submodules',
+             '--shallow-submodules', '--jobs=8',
+             'https://github.com/qbicsoftware/qcprot', workflow.dirs.src],
+            check=True, stdout=subprocess.DEVNULL, umask=0
         )
-        check_call.assert_any_call(
-            [
-                'git',
-                '--work-tree', workflow.dirs.src,
-                '--git-dir', os.path.join(workflow.dirs.src, '.git'),
-                'checkout',
-                'HEAD',
-            ]
+    finally:
+        shutil.rmtree(tmp)
+
+
+@mock.patch('subprocess.run')
+def test_clone_ref_fallback(run):
+    tmp = tempfile.mkdtemp()
+    try:
+        target = os.path.join(tmp, 'QTEST')
+        run.side_effect = [subprocess.CalledProcessError(128, 'git'),
+                           None, None]
+        utils.clone('https://example.com/repo', target, commit='abc123')
+        assert run.call_count == 3
+        run.assert_called_with(
+            ['git', '-C', target, 'checkout', 'abc123'],
+            check=True, stdout=subprocess.DEVNULL, umask=0
         )
     finally:
         shutil.rmtree(tmp)
 
 
+@mock.patch('subprocess.run')
+def test_clone_ref_failed_submodule(run):
+    tmp = tempfile.mkdtemp()
+    try:
+        target = os.path.join(tmp, 'QTEST')
+
+        def failing_clone(*args, **kwargs):
+            # git keeps the checkout if only the submodules failed
+            touch(os.path.join(target, 'run'))
+            raise subprocess.CalledProcessError(1, 'git')
+
+        run.side_effect = failing_clone
+        with pytest.raises(subprocess.CalledProcessError):
+            utils.clone('https://example.com/repo', target, commit='v2')
+        assert run.call_count == 1
+    finally:
+        shutil.rmtree(tmp)
+
+
 @mock.patch('subprocess.Popen')
 @mock.patch('subprocess.check_call')
 def test_run(Popen, check_call):
@@ -74,3 +126,266 @@ def test_commit():
         assert not os.path.isdir(os.path.join(tmp, 'result', 'evil'))
     finally:
         shutil.rmtree(tmp)
+
+
+def test_copyfile():
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src')
+        dest = os.path.join(tmp, 'dest')
+        content = os.urandom(3 * 1024 * 1024 + 17)
+        with open(src, 'wb') as f:
+            f.write(content)
+        utils.copyfile(src, dest)
+        with open(dest, 'rb') as f:
+            assert f.read() == content
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_write_zip():
+    import io
+    import zipfile
+
+    tmp = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp, 'dir'))
+        with open(os.path.join(tmp, 'dir', 'text'), 'w') as f:
+            f.write('a' * 1000)
+        touch(os.path.join(tmp, 'dir', 'data.gz'))
+        touch(os.path.join(tmp, 'meta.json'))
+        dest = io.BytesIO()
+        utils.write_zip([os.path.join(tmp, 'dir'),
+                         os.path.join(tmp, 'meta.json')], dest)
+        prefix = tmp.lstrip('/') + '/'
+        with zipfile.ZipFile(dest) as zf:
+            assert zf.read(prefix + 'dir/text') == b'a' * 1000
+            infos = dict((info.filename, info) for info in zf.infolist())
+        assert infos[prefix + 'dir/'].is_dir()
+        assert (infos[prefix + 'dir/text'].compress_type ==
+                zipfile.ZIP_DEFLATED)
+        assert (infos[prefix + 'dir/data.gz'].compress_type ==
+                zipfile.ZIP_STORED)
+        assert prefix + 'meta.json' in infos
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_write_zip_skips_special_files():
+    import io
+    import zipfile
+
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src')
+        os.mkdir(src)
+        os.mkfifo(os.path.join(src, 'fifo'))
+        os.symlink(os.path.join(tmp, 'missing'), os.path.join(src, 'dangling'))
+        touch(os.path.join(src, 'target'))
+        os.symlink(os.path.join(src, 'target'), os.path.join(src, 'link'))
+        touch(os.path.join(src, 'old'))
+        os.utime(os.path.join(src, 'old'), (0, 0))
+        dest = io.BytesIO()
+        utils.write_zip([src], dest)
+        prefix = src.lstrip('/') + '/'
+        with zipfile.ZipFile(dest) as zf:
+            names = set(zf.namelist())
+            old = zf.getinfo(prefix + 'old')
+        assert names == set([prefix, prefix + 'target', prefix + 'link',
+                             prefix + 'old'])
+        assert old.date_time == (1980, 1, 1, 0, 0, 0)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_copytree_owner_failed_copy():
+    import errno
+    import time
+
+    tmp = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src')
+        dest = os.path.join(tmp, 'dest')
+        # Directory fds below the top level are closed by the walk itself
+        os.makedirs(os.path.join(src, 'sub'))
+        os.mkdir(dest)
+        for i in range(6):
+            with open(os.path.join(src, 'sub', 'f%s' % i), 'w') as f:
+                f.write('data%s' % i)
+        copy_to_dir = utils._copy_to_dir
+        # Fail the file that is copied first, while the others still run
+        first = os.listdir(os.path.join(src, 'sub'))[0]
+
+        def failing_copy(src_fd, dest_fd, name):
+            if name == first:
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            time.sleep(0.1)
+            copy_to_dir(src_fd, dest_fd, name)
+
+        with mock.patch.object(utils, '_copy_to_dir', failing_copy):
+            with pytest.raises(OSError) as error:
+                utils.copytree_owner(src, dest, os.getuid(), max_workers=6)
+        assert error.value.errno == errno.ENOSPC
+        for i in range(6):
+            name = 'f%s' % i
+            if name == first:
+                continue
+            with open(os.path.join(dest, 'sub', name)) as f:
+                assert f.read() == 'data%s' % i
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_copy_data_duplicate_names():
+    tmp = tempfile.mkdtemp()
+    try:
+        data = []
+        for name in ['d1', 'd2']:
+            os.mkdir(os.path.join(tmp, name))
+            data.append(os.path.join(tmp, name, 'in'))
+            touch(data[-1])
+        target = os.path.join(tmp, 'target')
+        os.mkdir(target)
+        with pytest.raises(ValueError):
+            projects.copy_data(target, data)
+        assert os.listdir(target) == []
+    finally:
+        shutil.rmtree(tmp)
+
+
+def test_log_output():
+    process = subprocess.Popen(
+        ['sh', '-c', 'printf "first\\nsecond\\nlast"; exit 3'],
+        stdout=subprocess.PIPE
+    )
+    with mock.patch.object(utils, 'logger') as logger:
+        assert utils.log_output(process, bufsize=4) == 3
+    assert logger.info.call_args_list == [
+        mock.call("workflow: %s", line)
+        for line in ['first', 'second', 'last']
+    ]
+
+
+def test_log_output_background_process():
+    import time
+
+    process = subprocess.Popen(
+        ['sh', '-c', 'sleep 5 & echo started'], stdout=subprocess.PIPE
+    )
+    start = time.time()
+    with mock.patch.object(utils, 'logger') as logger:
+        assert utils.log_output(process) == 0
+    assert time.time() - start < 4
+    logger.info.assert_called_once_with("workflow: %s", 'started')
+
+
+@mock.patch('subprocess.check_call')
+@mock.patch.object(utils, 'posix1e', None)
+def test_add_acl_setfacl(check_call):
+    utils.add_acl_many(['a', 'b'], 'r-x', 'alice', 'staff')
+    check_call.assert_called_once_with(
+        ['setfacl', '-m', 'u:alice:r-x,g:staff:r-x', 'a', 'b']
+    )
+
+    check_call.reset_mock()
+    files = ['/data/%04d/%s' % (i, 'x' * 100) for i in range(5000)]
+    utils.add_acl_many(files, 'r', 'alice')
+    assert check_call.call_count > 1
+    passed = []
+    for args, _ in check_call.call_args_list:
+        assert args[0][:3] == ['setfacl', '-m', 'u:alice:r']
+        assert sum(len(f) + 1 for f in args[0][3:]) <= utils.SETFACL_ARGS_SIZE
+        passed.extend(args[0][3:])
+    assert passed == files
+
+    check_call.side_effect = OSError(7, 'Argument list too long')
+    utils.add_acl_many(['a'], 'r', 'alice')
+
+
+class FakeEntry(object):
+    def __init__(self, tag_type=None, qualifier=None, permset=()):
+        self.tag_type = tag_type
+        self.qualifier = qualifier
+        self.permset = set(permset)
+
+
+class FakeACL(object):
+    instances = []
+
+    def __init__(self, file):
+        self.file = file
+        self.entries = [FakeEntry('user', 1000, ['read', 'write'])]
+        self.applied_to = None
+        FakeACL.instances.append(self)
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def append(self):
+        entry = FakeEntry()
+        self.entries.append(entry)
+        return entry
+
+    def calc_mask(self):
+        pass
+
+    def applyto(self, file):
+        self.applied_to = file
+
+
+fake_posix1e = mock.Mock(
+    ACL=FakeACL, ACL_USER='user', ACL_GROUP='group', ACL_READ='read',
+    ACL_WRITE='write', ACL_EXECUTE='execute'
+)
+
+
+@mock.patch.object(utils, 'posix1e', fake_posix1e)
+@mock.patch.object(utils, 'group_id', return_value=2000)
+@mock.patch.object(utils, 'user_id', return_value=1000)
+def test_add_acl_pylibacl(user_id, group_id):
+    FakeACL.instances = []
+    utils.add_acl_many(['a', 'b'], 'r-x', 'alice', 'staff')
+    assert [acl.applied_to for acl in FakeACL.instances] == ['a', 'b']
+    for acl in FakeACL.instances:
+        # The existing entry of the user is updated, the group is appended
+        assert len(acl.entries) == 2
+        user, group = acl.entries
+        assert (user.tag_type, user.qualifier) == ('user', 1000)
+        assert user.permset == set(['read', 'execute'])
+        assert (group.tag_type, group.qualifier) == ('group', 2000)
+        assert group.permset == set(['read', 'execute'])
+
+    FakeACL.instances = []
+    user_id.side_effect = KeyError('getpwnam(): name not found: alice')
+    utils.add_acl_many(['a'], 'r', 'alice')
+    assert FakeACL.instances == []
+
+
+@mock.patch.object(commandline, 'init_logging')
+def test_run_daemon_foreground_exit_code(init_logging):
+    tmp = tempfile.mkdtemp()
+    umask = os.umask(0o022)
+    try:
+        target = os.path.join(tmp, 'QTEST')
+        workflow = projects.Workflow(target, name='QTEST')
+        workflow.create()
+        run = os.path.join(workflow.dirs.src, 'run')
+        with open(run, 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+        os.chmod(run, 0o755)
+        argv = ['qproject', 'run', '--target', target, '--daemon',
+                '--foreground', '--pidfile', os.path.join(tmp, 'pid')]
+        with mock.patch('sys.argv', argv):
+            with pytest.raises(SystemExit) as exit:
+                commandline.main()
+        assert exit.value.code == 1
+        assert os.listdir(workflow.dirs.archive) == []
+
+        argv = ['qproject', 'run', '--target', target, '--foreground']
+        with mock.patch('sys.argv', argv):
+            with pytest.raises(SystemExit) as exit:
+                commandline.main()
+        assert exit.value.code == 1
+    finally:
+        os.umask(umask)
+        shutil.rmtree(tmp)